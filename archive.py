@@ -11,6 +11,11 @@
 # v1.7: Add option to list archive directory contents
 # v1.8: Add ability to only archive files that have been modified in subversion
 # v1.9: List requested archived directories. Remove spaces from archive name
+# v1.10: Copy files on separate devices concurrently
+# v1.11: Copy files without cp. Preserve holes in sparse files
+# v1.12: List archive directories in sorted order with bounded memory, requires the scandir package
+# v1.13: Add watch mode to continuously archive changed files
+# v1.14: Create backup directories with timestamp_dir, so simultaneous archives don't collide
 
 # To Do: Add Logger
 # To Do: Add ability to backup subversion controlled files in specific sub directories
@@ -21,16 +26,30 @@
 
 import sys
 import os
-import datetime
 import getopt
 import subprocess
 import time
 import re
+import shutil
+import errno
 from optparse import OptionParser
 
+import fast_copy
+import timestamp_dir
+from copy_scheduler import CopyScheduler, DEFAULT_DEVICE_JOBS, DEFAULT_DEST_JOBS
+from external_sort import externalSort
+from inotify_watch import InotifyWatch
+
+# the scandir package streams directory listings, so --list uses bounded memory.
+# Without it the whole listing is read into memory with os.listdir
+try:
+	from scandir import scandir
+except ImportError:
+	scandir = None
+
 # OptionParser prog arguments
 PROGRAM_NAME="archive" 
-PROGRAM_VERSION = "1.9"
+PROGRAM_VERSION = "1.14"
 
 # get home directory
 DEFAULT_BACKUP_DIR = os.path.join(os.path.expanduser('~'), "archive")
@@ -38,6 +57,12 @@ DEFAULT_BACKUP_DIR = os.path.join(os.path.expanduser('~'), "archive")
 # files to ignore
 ignore_list = [".svn"]
 
+# in watch mode, seconds without changes before a snapshot is written
+DEFAULT_SETTLE_TIME = 2.0
+
+# in watch mode, maximum seconds changes are coalesced before a snapshot is forced
+MAX_COALESCE_TIME = 60.0
+
 # -----------------------------------------------------
 # Class SvnHandler
 # -----------------------------------------------------
@@ -240,24 +265,43 @@ class Archive(object):
 			print "Archive path %s doesn't exist" % archivePath
 			return
 		
-		# get immediate files and directories
-		dirList = os.listdir(archivePath)
+		# get immediate files and directories, sorted
+		empty = True
 
-		if not dirList:
-			# list is empty
-			print "Archive dir %s is empty" % archivePath
-			return
-
-		# sort the results
-		list.sort(dirList)
-
-		for name in dirList:
+		for name in self._sortedDirectory(archivePath):
+			empty = False
 			fullNamePath = os.path.join(archivePath, name)
 			if os.path.isfile(fullNamePath):
 				print "(file) %s" % fullNamePath
 			else:
 				print "(dir) %s" % fullNamePath
-			
+
+		if empty:
+			# list is empty
+			print "Archive dir %s is empty" % archivePath
+
+	# -----------------------------------------------------
+	# _sortedDirectory
+	# -----------------------------------------------------
+	def _sortedDirectory(self, dirPath):
+		"""
+		Return the names in a directory in sorted order. When the scandir
+		package is installed the listing is streamed through an external
+		sort, so large directories are never held in memory
+
+		ARGS:
+			dirPath: directory to read
+
+		RETURNS:
+			An iterable of the file and directory names in dirPath, sorted
+		"""
+
+		if scandir:
+			return externalSort(entry.name for entry in scandir(dirPath))
+
+		# os.listdir already holds the whole listing, an in memory sort is cheapest
+		return sorted(os.listdir(dirPath))
+
 	# -----------------------------------------------------
 	# createDirectory
 	# -----------------------------------------------------
@@ -315,7 +359,7 @@ class Archive(object):
 		SPACE = ' '
 		UNDERSCORE = '_'
 
-		if SPACE in folderName:
+		if folderName and SPACE in folderName:
 			# found at least once SPACE in the folder. Replace with UNDERSCORE
 			folderName = folderName.replace(SPACE, UNDERSCORE)
 
@@ -324,7 +368,7 @@ class Archive(object):
 	# -----------------------------------------------------
 	# backupFiles
 	# -----------------------------------------------------
-	def backupFiles(self, fileList, folderName, backupPath, preservePath, debug=False):
+	def backupFiles(self, fileList, folderName, backupPath, preservePath, debug=False, deviceJobs=DEFAULT_DEVICE_JOBS, destJobs=DEFAULT_DEST_JOBS, snapshotPath=None):
 		"""
 		main backup routine
 		
@@ -333,6 +377,10 @@ class Archive(object):
 		folderName: optional name to tack on to backup folder
 		backupPath: path where backup folder will be created
 		preserverPath: If True, preserve directory hierarchy for backed up files
+		deviceJobs: maximum number of copies reading from a single device at once
+		destJobs: maximum number of copies writing to a single device at once
+		snapshotPath: optional existing directory to backup into, such as one reserved
+			with timestamp_dir.reserveTSDirs. If not set a new timestamped directory is created
 		"""
 
 		# check input parameters
@@ -344,37 +392,44 @@ class Archive(object):
 			for file in fileList:
 				print "Backing up File %s" % file
 
-		# create the backup directory
-		directoryName = self.createTSString()
+		fullBackupPath = snapshotPath
 
-		folderName = self.formatArchiveFolderName(folderName)
+		if not fullBackupPath:
+			folderName = self.formatArchiveFolderName(folderName)
 
-		# add optional folder name to the backup directory
-		if folderName:
-			directoryName = '%s_%s' % (directoryName, folderName)
+			# create the timestamped backup directory, with the optional folder name added.
+			# The name is unique even if another archive starts at the same time
+			fullBackupPath = timestamp_dir.createTSDir(backupPath, folderName)
+			print "created directory ", fullBackupPath
 
-		# construct the full backup path
-		fullBackupPath = '%s/%s' % (backupPath, directoryName)
+		def copyFile(source, dest):
+			""" copy a single file and its permissions, like cp """
 
-		# create the entire backup directory path
-		self.createDirectory(fullBackupPath)
+			print "'%s' -> '%s'" % (source, dest)
 
-		copyCmd = "cp -v"
+			# sparse files and large files are copied without reading their holes
+			fast_copy.copyFile(source, dest)
+			shutil.copymode(source, dest)
 
-		# if specified, preserve the directory structure
-		if preservePath:
-			copyCmd += " --parents"
+		# copies on separate devices run in parallel
+		scheduler = CopyScheduler(copyFile, deviceJobs, destJobs)
 
 		for fileToCopy in fileList:
 
-			# construct copy command
-			cmd = "%s %s %s" % (copyCmd, fileToCopy, fullBackupPath)
+			# if specified, preserve the directory structure
+			if preservePath:
+				destFile = os.path.join(fullBackupPath, fileToCopy.lstrip(os.sep))
+				self.createDirectory(os.path.dirname(destFile))
+			else:
+				destFile = os.path.join(fullBackupPath, os.path.basename(fileToCopy))
 
 			if debug:
-				"copy cmd: %s" % cmd
+				print "copy %s to %s" % (fileToCopy, destFile)
+
+			scheduler.addCopy(fileToCopy, destFile)
 
-			# perform the copy
-			os.system(cmd)
+		for source, dest, error in scheduler.run():
+			print "Unable to copy %s to %s: %s" % (source, dest, error)
 
 		# change permissions on archive file
 		self.makeFilesReadOnly(fullBackupPath)
@@ -385,7 +440,7 @@ class Archive(object):
 	def createTSString(self):
 		""" Generate a timestamp string """
 
-		return datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+		return timestamp_dir.formatTimestamp()
 
 	# -----------------------------------------------------
 	# getAbsoluteFilePaths
@@ -440,6 +495,132 @@ class Archive(object):
 
 		return returnList
 
+# -----------------------------------------------------
+# Class ArchiveWatcher
+# -----------------------------------------------------
+class ArchiveWatcher(object):
+	"""
+	Continuously archive files as they change, using inotify
+	"""
+
+	# -----------------------------------------------------
+	# __init__
+	# -----------------------------------------------------
+	def __init__(self, archiver):
+		"""
+		constructor
+
+		ARGS:
+			archiver: Archive used to write snapshots
+		"""
+
+		self.archiver = archiver
+
+	# -----------------------------------------------------
+	# watch
+	# -----------------------------------------------------
+	def watch(self, fileList, folderName, backupPath, preservePath, settleTime=DEFAULT_SETTLE_TIME, deviceJobs=DEFAULT_DEVICE_JOBS, destJobs=DEFAULT_DEST_JOBS):
+		"""
+		Archive fileList once, then watch it and write a snapshot of only
+		the changed files whenever a burst of changes settles. Runs until
+		interrupted. Exits if the inotify watch limit is reached
+
+		ARGS:
+			fileList: files and directories to watch
+			folderName: optional name to tack on to each snapshot folder
+			backupPath: path where snapshot folders will be created
+			preservePath: If True, preserve directory hierarchy for backed up files
+			settleTime: seconds without changes before a snapshot is written
+			deviceJobs: maximum number of copies reading from a single device at once
+			destJobs: maximum number of copies writing to a single device at once
+		"""
+
+		# never watch the archive itself, or every snapshot would trigger another one
+		watcher = InotifyWatch(excludePaths=[backupPath], ignoreNames=ignore_list)
+
+		try:
+			# add the watches before the first snapshot so no change is missed
+			for path in fileList:
+				watcher.addWatch(path)
+
+			print "Watching %d paths" % len(watcher.watches)
+
+			self._snapshot(self._getAllFiles(fileList, watcher), folderName, backupPath, preservePath, deviceJobs, destJobs)
+
+			pendingFiles = set()
+			burstStart = None
+
+			while True:
+				# wait forever for the first change of a burst. Then wait until no event of
+				# any kind has arrived for settleTime, or the burst has lasted too long
+				timeout = None
+				if burstStart:
+					deadline = min(watcher.lastEventTime + settleTime, burstStart + MAX_COALESCE_TIME)
+					timeout = max(0, deadline - time.time())
+
+				changedFiles = watcher.readChanges(timeout)
+
+				if watcher.overflowed:
+					# events were lost, archive everything in the next snapshot
+					print "inotify event queue overflowed. Next snapshot includes all files"
+					watcher.overflowed = False
+					changedFiles = set(self._getAllFiles(fileList, watcher))
+
+				if changedFiles:
+					pendingFiles.update(changedFiles)
+					if not burstStart:
+						burstStart = time.time()
+
+				if not pendingFiles:
+					continue
+
+				# events that changed no files, like a new empty directory, still extend the burst
+				now = time.time()
+				if now - watcher.lastEventTime < settleTime and now - burstStart < MAX_COALESCE_TIME:
+					continue
+
+				self._snapshot(sorted(pendingFiles), folderName, backupPath, preservePath, deviceJobs, destJobs)
+
+				pendingFiles = set()
+				burstStart = None
+
+		except KeyboardInterrupt:
+			print "Stopped watching"
+
+		except OSError, e:
+			if e.errno != errno.ENOSPC:
+				raise
+
+			# inotify_add_watch fails with ENOSPC when the per user watch limit is reached
+			print "Unable to watch all directories, the inotify watch limit was reached (%d watches added)." % len(watcher.watches)
+			print "Raise the limit with: sysctl fs.inotify.max_user_watches=<number>"
+			sys.exit(1)
+
+		finally:
+			watcher.close()
+
+	# -----------------------------------------------------
+	# _getAllFiles
+	# -----------------------------------------------------
+	def _getAllFiles(self, fileList, watcher):
+		""" Return all files in fileList that are not ignored by the watcher """
+
+		return [path for path in self.archiver.getAbsoluteFilePaths(fileList) if not watcher.isIgnored(path)]
+
+	# -----------------------------------------------------
+	# _snapshot
+	# -----------------------------------------------------
+	def _snapshot(self, fileList, folderName, backupPath, preservePath, deviceJobs, destJobs):
+		""" archive the files that still exist to a new timestamped folder """
+
+		fileList = [path for path in fileList if os.path.isfile(path)]
+
+		if not fileList:
+			return
+
+		print "Archiving %d changed files" % len(fileList)
+		self.archiver.backupFiles(fileList, folderName, backupPath, preservePath, deviceJobs=deviceJobs, destJobs=destJobs)
+
 # -----------------------------------------------------
 # usage
 # -----------------------------------------------------
@@ -450,6 +631,7 @@ def usage():
 	print "if given a directory, back that directory up. If no directory provided, backup current directory"
 	print argv[0], "--l"
 	print argv[0], "--l <folder>"
+	print argv[0], "--watch <list of files to backup>"
 
 # -----------------------------------------------------
 # addOptions
@@ -461,6 +643,10 @@ def addOptions(parser):
 	parser.add_option("--preservePath", "-p", dest="preservePath", action='store_const', const=True,  help="preserve directory structure in destination directory")
 	parser.add_option("--list", "-l", dest="listArchive", action='store_const', const=True,  help="List the contents of an archived directory")
 	parser.add_option("--svn", dest="svnModified", action='store_const', const=True,  help="Only archive files that are marked as modified ('A', 'M') by subversion ")
+	parser.add_option("--watch", "-w", dest="watch", action='store_const', const=True,  help="Keep running and archive files as they change")
+	parser.add_option("--settle", dest="settleTime", type="float", default=DEFAULT_SETTLE_TIME, help="in watch mode, seconds without changes before a snapshot is written")
+	parser.add_option("--deviceJobs", "-j", dest="deviceJobs", type="int", default=DEFAULT_DEVICE_JOBS, help="maximum number of concurrent copies reading from each device")
+	parser.add_option("--destJobs", dest="destJobs", type="int", default=DEFAULT_DEST_JOBS, help="maximum number of concurrent copies writing to each device")
 
 # -----------------------------------------------------
 # main
@@ -478,6 +664,9 @@ def main():
 	# parse the arguments
 	(options, args) = parser.parse_args()
 
+	if options.deviceJobs < 1 or options.destJobs < 1:
+		parser.error("--deviceJobs and --destJobs must be at least 1")
+
 	# perform the backup
 	archiver = Archive()
 
@@ -512,8 +701,21 @@ def main():
 
 		handler = SvnHandler()
 		backupFiles = handler.getModifiedSvnFiles(debug=False)
-		archiver.backupFiles(backupFiles, options.folderName, options.backupPath, options.preservePath)
+		archiver.backupFiles(backupFiles, options.folderName, options.backupPath, options.preservePath, deviceJobs=options.deviceJobs, destJobs=options.destJobs)
 		
+	elif options.watch:
+		####################################
+		# continuously backup changed files
+		####################################
+
+		if not args:
+			parser.error("No arguments received")
+
+		fileList = archiver.getAbsoluteFilePaths(args, False)
+
+		watcher = ArchiveWatcher(archiver)
+		watcher.watch(fileList, options.folderName, options.backupPath, options.preservePath, options.settleTime, options.deviceJobs, options.destJobs)
+
 	else:
 		####################################
 		# backup files and directories specified on the command line
@@ -528,7 +730,7 @@ def main():
 		fileList = archiver.getAbsoluteFilePaths(args)
 
 		# backup files and directories specified by the command line
-		archiver.backupFiles(fileList, options.folderName, options.backupPath, options.preservePath, debug=False)
+		archiver.backupFiles(fileList, options.folderName, options.backupPath, options.preservePath, debug=False, deviceJobs=options.deviceJobs, destJobs=options.destJobs)
 
 # execute main
 if __name__ == "__main__":
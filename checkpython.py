@@ -1,15 +1,206 @@
 #!/usr/bin/python
-# Compile python, and do tabnanny check
+# Compile python, and do tabnanny check. Each file is read once and compiled
+# in memory, no .pyc files are written
 
 import os
 import sys
-import py_compile
+import json
+import hashlib
+import argparse
+import tokenize
 import tabnanny
+import multiprocessing
+from cStringIO import StringIO
 
-def print_usage():
-	""" Print usage for program """
-	print 'usage: %s [PYTHON FILE] [PYTHON FILE] ...' % (sys.argv[0])
-	print 'usage: %s --help' % (sys.argv[0])
+# cache of content hashes for files that passed every check
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), ".checkpython_cache")
+
+# bump when the checks change, so older cached results are not trusted
+CACHE_VERSION = 1
+
+# result status for each file
+STATUS_OK = "ok"
+STATUS_CACHED = "cached"
+STATUS_FAILED = "failed"
+
+# hashes of files known to pass, set in each worker process
+passedHashes = set()
+
+# ============================================================================
+# findPythonFiles
+# ============================================================================
+def findPythonFiles(paths):
+	"""
+	Expand a list of files and directories into the python files to check.
+	Directories are searched recursively for .py files
+
+	RETURNS:
+		(list of python files, list of paths that don't exist)
+	"""
+
+	pythonFiles = []
+	missing = []
+
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, files in os.walk(path):
+				for name in files:
+					if name.endswith(".py"):
+						pythonFiles.append(os.path.join(root, name))
+
+		elif os.path.exists(path):
+			pythonFiles.append(path)
+
+		else:
+			missing.append(path)
+
+	return pythonFiles, missing
+
+# ============================================================================
+# loadCache
+# ============================================================================
+def loadCache(cacheFile):
+	""" Return the set of content hashes that passed every check """
+
+	try:
+		with open(cacheFile) as cache:
+			data = json.load(cache)
+	except (IOError, ValueError):
+		return set()
+
+	if data.get("version") != CACHE_VERSION:
+		return set()
+
+	return set(data.get("passed", []))
+
+# ============================================================================
+# saveCache
+# ============================================================================
+def saveCache(cacheFile, hashes):
+	"""
+	Save the content hashes that passed every check. Failing to write the
+	cache only prints a warning, the checks themselves are unaffected
+	"""
+
+	tempFile = "%s.%d" % (cacheFile, os.getpid())
+
+	try:
+		with open(tempFile, "w") as cache:
+			json.dump({"version" : CACHE_VERSION, "passed" : sorted(hashes)}, cache)
+
+		# replace the old cache in one step so a crash can't corrupt it
+		os.rename(tempFile, cacheFile)
+
+	except (IOError, OSError), e:
+		print >> sys.stderr, "Warning: unable to write cache %s: %s" % (cacheFile, e)
+
+		# don't leave a partial temporary file behind
+		try:
+			os.remove(tempFile)
+		except OSError:
+			pass
+
+# ============================================================================
+# initWorker
+# ============================================================================
+def initWorker(hashes):
+	""" Give a worker process the hashes of files known to pass """
+
+	global passedHashes
+	passedHashes = hashes
+
+# ============================================================================
+# checkFile
+# ============================================================================
+def checkFile(fileToCheck):
+	"""
+	Compile a python file and tabnanny check it. Files whose contents
+	are in the cache of passed files are skipped
+
+	RETURNS:
+		A dictionary describing the result for the file
+	"""
+
+	result = {"file" : fileToCheck, "status" : STATUS_OK, "errors" : []}
+
+	# read the file once. Hashing, compiling and tab checking all use this copy
+	try:
+		with open(fileToCheck, "rb") as sourceFile:
+			source = sourceFile.read()
+	except IOError, e:
+		result["status"] = STATUS_FAILED
+		result["errors"].append("read: %s" % e)
+		return result
+
+	contentHash = hashlib.sha1(source).hexdigest()
+	result["hash"] = contentHash
+
+	if contentHash in passedHashes:
+		result["status"] = STATUS_CACHED
+		return result
+
+	# compile the file in memory
+	try:
+		compile(source, fileToCheck, "exec", 0, True)
+	except SyntaxError, e:
+		result["errors"].append("compile: line %s: %s" % (e.lineno, e.msg))
+	except (TypeError, ValueError), e:
+		# source containing null bytes
+		result["errors"].append("compile: %s" % e)
+
+	# perform tab check on the same source
+	try:
+		tabnanny.process_tokens(tokenize.generate_tokens(StringIO(source).readline))
+	except tabnanny.NannyNag, e:
+		result["errors"].append("tabnanny: line %d: %s" % (e.get_lineno(), e.get_msg()))
+	except (tokenize.TokenError, IndentationError, SyntaxError), e:
+		result["errors"].append("tabnanny: %s" % e)
+
+	if result["errors"]:
+		result["status"] = STATUS_FAILED
+
+	return result
+
+# ============================================================================
+# checkFiles
+# ============================================================================
+def checkFiles(files, jobs, hashes):
+	"""
+	Check files in parallel
+
+	ARGS:
+		files: python files to check
+		jobs: number of worker processes
+		hashes: content hashes of files known to pass
+
+	RETURNS:
+		A list of result dictionaries, sorted by file name
+	"""
+
+	if jobs == 1:
+		initWorker(hashes)
+		results = [checkFile(fileToCheck) for fileToCheck in files]
+	else:
+		pool = multiprocessing.Pool(jobs, initWorker, (hashes,))
+		try:
+			results = pool.map(checkFile, files, chunksize=16)
+		finally:
+			pool.close()
+			pool.join()
+
+	results.sort(key=lambda result: result["file"])
+	return results
+
+# ============================================================================
+# defineArgs
+# ============================================================================
+def defineArgs(parser):
+	""" Set the arguments of the arg parser """
+	parser.add_argument('paths', nargs='+', help='python files, or directories to search for python files')
+	parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(), help='number of files checked in parallel')
+	parser.add_argument('--report', help='write a JSON report of every file to this path. Use - for stdout')
+	parser.add_argument('--cache', default=DEFAULT_CACHE_FILE, help='file caching the hashes of files that passed')
+	parser.add_argument('--no-cache', dest='use_cache', action='store_false', help='check every file, even if it passed before')
 
 # ============================================================================
 # main
@@ -18,38 +209,54 @@ def print_usage():
 def main():
 	"""
 	Can receive multiple arguments, all of which are assumed to be python
-	files.
+	files or directories containing python files.
 	Perform the following checks:
-		1) Compile Python files
+		1) Compile Python files, in memory
 		2) Tabnanny Python files
+	Exits with 1 if any file fails a check
 	"""
 
-	# get arguments
-	if len(sys.argv) == 2 and sys.argv[1] == "--help":
-		print_usage()
-		sys.exit(0)
-	elif len(sys.argv) < 2:
-		print 'At least 2 arguments are required. Received: %d arguments' % len(sys.argv)
-		print_usage()
-		sys.exit(1)
+	parser = argparse.ArgumentParser(description="Compile and tabnanny check python files")
+	defineArgs(parser)
+	args = parser.parse_args()
+
+	files, missing = findPythonFiles(args.paths)
+
+	for path in missing:
+		print >> sys.stderr, "Unable to find file %s!" % path
+
+	hashes = set()
+	if args.use_cache:
+		hashes = loadCache(args.cache)
+
+	results = checkFiles(files, max(1, args.jobs), hashes)
+
+	failed = [result for result in results if result["status"] == STATUS_FAILED]
+	cached = [result for result in results if result["status"] == STATUS_CACHED]
+
+	for result in failed:
+		for error in result["errors"]:
+			print >> sys.stderr, "%s: %s" % (result["file"], error)
+
+	if args.use_cache:
+		# only keep hashes of files seen in this run, so the cache doesn't grow forever
+		saveCache(args.cache, set(result["hash"] for result in results if result["status"] in [STATUS_OK, STATUS_CACHED]))
 
-	# check all files
-	for index in range(1, len(sys.argv)):
+	exitCode = 1 if failed or missing else 0
 
-		fileToCheck = sys.argv[index]
+	if args.report:
+		report = {"checked" : len(results), "cached" : len(cached), "failed" : len(failed), "missing" : missing, "exit_code" : exitCode, "files" : results}
 
-		# make sure the file exists
-		if not os.path.exists(fileToCheck):
-			print "Unable to find file %s!" % fileToCheck
-			continue
+		if args.report == "-":
+			json.dump(report, sys.stdout, indent=2)
+			print
+		else:
+			with open(args.report, "w") as reportFile:
+				json.dump(report, reportFile, indent=2)
 
-		# compile the file
-		print "compile %s...." % fileToCheck
-		py_compile.compile(fileToCheck)
+	print >> sys.stderr, "Checked %d files: %d failed, %d unchanged since last pass" % (len(results), len(failed), len(cached))
 
-		# perform tab check on file
-		print "tabnanny %s...." % fileToCheck
-		tabnanny.check(fileToCheck)
+	sys.exit(exitCode)
 
 # ============================================================================
 # call main
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+#
+###############################################################################################################
+# Schedule file copies concurrently, limiting the number of copies active on each storage device
+#
+# Copies are grouped by the st_dev of their source file and destination directory. Each group is
+# serviced by its own worker threads, so copies between separate devices run in parallel. Reads from
+# a device and writes to a device have separate limits, so several sources can be read one at a
+# time each while all of them write to the same destination.
+###############################################################################################################
+
+import os
+import threading
+import Queue
+
+# seconds between checks for an interrupt while waiting for copies
+JOIN_POLL_TIME = 0.5
+
+# default number of copies allowed to read from a single device at once
+DEFAULT_DEVICE_JOBS = 1
+
+# default number of copies allowed to write to a single device at once
+DEFAULT_DEST_JOBS = 4
+
+# -----------------------------------------------------
+# getDevice
+# -----------------------------------------------------
+def getDevice(path):
+	"""
+	Return the device id of a path. If the path does not exist yet, use
+	the device of its closest existing parent directory
+
+	ARGS:
+		path: file or directory path
+
+	RETURNS:
+		st_dev of the path
+	"""
+
+	path = os.path.abspath(path)
+
+	while not os.path.exists(path):
+		parent = os.path.dirname(path)
+		if parent == path:
+			break
+		path = parent
+
+	return os.stat(path).st_dev
+
+# -----------------------------------------------------
+# Class CopyScheduler
+# -----------------------------------------------------
+class CopyScheduler(object):
+	"""
+	Run copy jobs concurrently with a per device concurrency limit
+	"""
+
+	# -----------------------------------------------------
+	# __init__
+	# -----------------------------------------------------
+	def __init__(self, copyFunc, deviceJobs=DEFAULT_DEVICE_JOBS, destJobs=DEFAULT_DEST_JOBS):
+		"""
+		constructor
+
+		ARGS:
+			copyFunc: function called as copyFunc(source, dest) to perform a single copy
+			deviceJobs: maximum number of copies reading from one device at a time
+			destJobs: maximum number of copies writing to one device at a time
+		"""
+
+		if deviceJobs < 1:
+			raise ValueError("deviceJobs must be at least 1, received %d" % deviceJobs)
+
+		if destJobs < 1:
+			raise ValueError("destJobs must be at least 1, received %d" % destJobs)
+
+		self.copyFunc = copyFunc
+		self.deviceJobs = deviceJobs
+		self.destJobs = destJobs
+
+		# queued jobs, keyed by (source device, destination device)
+		self.groups = {}
+		self.queuedCount = 0
+
+		# one semaphore per device for reads, and one for writes, shared by every group using that device
+		self.deviceLocks = {}
+
+		self.failures = []
+		self.failuresLock = threading.Lock()
+
+		# set to make workers stop taking new jobs
+		self.stopEvent = threading.Event()
+
+	# -----------------------------------------------------
+	# addCopy
+	# -----------------------------------------------------
+	def addCopy(self, source, dest):
+		"""
+		Queue a copy of source to dest
+
+		ARGS:
+			source: file to copy
+			dest: destination file or directory. The parent directory should exist
+		"""
+
+		sourceDev = getDevice(source)
+		destDev = getDevice(dest)
+
+		groupKey = (sourceDev, destDev)
+		if groupKey not in self.groups:
+			self.groups[groupKey] = Queue.Queue()
+
+		readKey = ("read", sourceDev)
+		if readKey not in self.deviceLocks:
+			self.deviceLocks[readKey] = threading.BoundedSemaphore(self.deviceJobs)
+
+		writeKey = ("write", destDev)
+		if writeKey not in self.deviceLocks:
+			self.deviceLocks[writeKey] = threading.BoundedSemaphore(self.destJobs)
+
+		self.groups[groupKey].put((source, dest))
+		self.queuedCount += 1
+
+	# -----------------------------------------------------
+	# run
+	# -----------------------------------------------------
+	def run(self):
+		"""
+		Perform all queued copies and wait for them to complete. If
+		interrupted, copies in progress finish, the remaining queued copies
+		are dropped and KeyboardInterrupt is raised again
+
+		RETURNS:
+			A list of (source, dest, error) tuples for copies that failed
+		"""
+
+		workers = []
+		self.stopEvent.clear()
+
+		for groupKey, jobQueue in self.groups.iteritems():
+
+			# never start more workers than a group can run at once, or has jobs
+			workerCount = min(self.deviceJobs, self.destJobs, jobQueue.qsize())
+
+			for index in range(workerCount):
+				worker = threading.Thread(target=self._worker, args=(groupKey, jobQueue))
+				worker.daemon = True
+				worker.start()
+				workers.append(worker)
+
+		try:
+			self._joinWorkers(workers)
+		except KeyboardInterrupt:
+			print "Interrupted. Waiting for copies in progress to finish"
+			self.stopEvent.set()
+			self._joinWorkers(workers)
+			raise
+		finally:
+			self.groups = {}
+			self.queuedCount = 0
+
+		failures = self.failures
+		self.failures = []
+		return failures
+
+	# -----------------------------------------------------
+	# _joinWorkers
+	# -----------------------------------------------------
+	def _joinWorkers(self, workers):
+		""" wait for workers to exit. Joins with a timeout so signals are handled on python 2 """
+
+		for worker in workers:
+			while worker.isAlive():
+				worker.join(JOIN_POLL_TIME)
+
+	# -----------------------------------------------------
+	# _worker
+	# -----------------------------------------------------
+	def _worker(self, groupKey, jobQueue):
+		""" copy files from a group queue until it is empty """
+
+		# acquire device locks in a fixed order so two groups can't deadlock
+		sourceDev, destDev = groupKey
+		lockKeys = sorted([("read", sourceDev), ("write", destDev)])
+
+		while not self.stopEvent.is_set():
+			try:
+				source, dest = jobQueue.get_nowait()
+			except Queue.Empty:
+				return
+
+			for lockKey in lockKeys:
+				self.deviceLocks[lockKey].acquire()
+
+			try:
+				self.copyFunc(source, dest)
+			except Exception, e:
+				with self.failuresLock:
+					self.failures.append((source, dest, e))
+			finally:
+				for lockKey in reversed(lockKeys):
+					self.deviceLocks[lockKey].release()
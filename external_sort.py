@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+###############################################################################################################
+# Sort more items than fit in memory
+#
+# Items are collected into runs of a fixed size. Each run is sorted and spilled to a temporary file,
+# then the runs are merged as a stream. Items must be marshal-able: strings, numbers, and tuples of them.
+###############################################################################################################
+
+import heapq
+import marshal
+import tempfile
+
+# number of items held in memory before a sorted run is written to disk
+DEFAULT_RUN_SIZE = 100000
+
+# -----------------------------------------------------
+# _writeRun
+# -----------------------------------------------------
+def _writeRun(run, tempDir):
+	"""
+	Write a sorted run to a temporary file
+
+	RETURNS:
+		The temporary file, rewound to the start. It is deleted when closed
+	"""
+
+	runFile = tempfile.TemporaryFile(dir=tempDir)
+
+	for item in run:
+		marshal.dump(item, runFile)
+
+	runFile.seek(0)
+	return runFile
+
+# -----------------------------------------------------
+# _readRun
+# -----------------------------------------------------
+def _readRun(runFile):
+	""" Yield the items of a run file in order, closing the file at the end """
+
+	try:
+		while True:
+			try:
+				yield marshal.load(runFile)
+			except EOFError:
+				return
+	finally:
+		runFile.close()
+
+# -----------------------------------------------------
+# _mergeRuns
+# -----------------------------------------------------
+def _mergeRuns(merged, keyed):
+	""" Yield merged items, removing the sort keys added by externalSort """
+
+	for item in merged:
+		if keyed:
+			item = item[1]
+
+		yield item
+
+# -----------------------------------------------------
+# externalSort
+# -----------------------------------------------------
+def externalSort(items, key=None, runSize=DEFAULT_RUN_SIZE, tempDir=None):
+	"""
+	Sort an iterable using at most runSize items of memory. The input is
+	read and spilled to sorted runs before returning, the runs are then
+	merged as the result is iterated
+
+	ARGS:
+		items: iterable of items to sort
+		key: optional function returning the sort key of an item. The key must be marshal-able
+		runSize: maximum number of items held in memory at once
+		tempDir: directory for the temporary run files. Defaults to the system temp directory
+
+	RETURNS:
+		A generator yielding the items in sorted order
+	"""
+
+	runFiles = []
+	run = []
+
+	for item in items:
+		if key:
+			item = (key(item), item)
+
+		run.append(item)
+
+		if len(run) >= runSize:
+			run.sort()
+			runFiles.append(_writeRun(run, tempDir))
+			run = []
+
+	run.sort()
+
+	if not runFiles:
+		# everything fit in memory, no need to merge
+		return _mergeRuns(iter(run), key)
+
+	if run:
+		runFiles.append(_writeRun(run, tempDir))
+
+	return _mergeRuns(heapq.merge(*[_readRun(runFile) for runFile in runFiles]), key)
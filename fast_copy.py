@@ -0,0 +1,233 @@
+#!/usr/bin/python
+#
+###############################################################################################################
+# Copy large files without reading or writing the holes in sparse files
+#
+# Small files are copied with shutil.copyfile. Large files are copied one data segment at a time,
+# found with SEEK_DATA/SEEK_HOLE, using copy_file_range so the kernel moves the data. Large dense
+# files are preallocated with posix_fallocate before copying.
+###############################################################################################################
+
+import os
+import errno
+import shutil
+import ctypes
+import ctypes.util
+
+# files smaller than this are copied with shutil.copyfile
+LARGE_FILE_THRESHOLD = 64 * 1024 * 1024
+
+# maximum number of bytes moved by one copy_file_range or read call
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# lseek whence values for finding data and holes. Not defined by python 2 on Linux
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+# errors meaning copy_file_range can't be used for this pair of files
+COPY_RANGE_UNSUPPORTED_ERRORS = [errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP]
+
+# -----------------------------------------------------
+# libc functions not exposed by the os module on python 2
+# -----------------------------------------------------
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+	_libc = None
+
+_libcCopyFileRange = getattr(_libc, "copy_file_range", None)
+if _libcCopyFileRange:
+	_libcCopyFileRange.restype = ctypes.c_ssize_t
+	_libcCopyFileRange.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+
+_libcFallocate = getattr(_libc, "posix_fallocate64", None)
+if _libcFallocate:
+	_libcFallocate.restype = ctypes.c_int
+	_libcFallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+# -----------------------------------------------------
+# _copyFileRange
+# -----------------------------------------------------
+def _copyFileRange(sourceFd, destFd, offset, length):
+	"""
+	Copy length bytes at offset in sourceFd to the same offset in destFd with
+	copy_file_range
+
+	RETURNS:
+		The number of bytes copied. 0 at end of file
+	"""
+
+	if hasattr(os, "copy_file_range"):
+		return os.copy_file_range(sourceFd, destFd, length, offset, offset)
+
+	if not _libcCopyFileRange:
+		raise OSError(errno.ENOSYS, "copy_file_range is not available")
+
+	sourceOffset = ctypes.c_int64(offset)
+	destOffset = ctypes.c_int64(offset)
+
+	copied = _libcCopyFileRange(sourceFd, ctypes.byref(sourceOffset), destFd, ctypes.byref(destOffset), length, 0)
+	if copied < 0:
+		error = ctypes.get_errno()
+		raise OSError(error, os.strerror(error))
+
+	return copied
+
+# -----------------------------------------------------
+# _fallocate
+# -----------------------------------------------------
+def _fallocate(fd, length):
+	""" Preallocate length bytes for fd. Does nothing if the filesystem can't preallocate """
+
+	try:
+		if hasattr(os, "posix_fallocate"):
+			os.posix_fallocate(fd, 0, length)
+
+		elif _libcFallocate:
+			# posix_fallocate returns the error number instead of setting errno
+			error = _libcFallocate(fd, 0, length)
+			if error:
+				raise OSError(error, os.strerror(error))
+
+	except OSError, e:
+		if e.errno not in [errno.EINVAL, errno.EOPNOTSUPP]:
+			raise
+
+# -----------------------------------------------------
+# _getDataSegments
+# -----------------------------------------------------
+def _getDataSegments(fd, size):
+	"""
+	Find the regions of a file that contain data
+
+	RETURNS:
+		A list of (offset, length) tuples. The whole file is returned as one
+		segment if the filesystem does not support SEEK_DATA
+	"""
+
+	segments = []
+	offset = 0
+
+	try:
+		while offset < size:
+			try:
+				dataStart = os.lseek(fd, offset, SEEK_DATA)
+			except OSError, e:
+				if e.errno == errno.ENXIO:
+					# no data after offset, the rest of the file is a hole
+					break
+				raise
+
+			dataEnd = os.lseek(fd, dataStart, SEEK_HOLE)
+			segments.append((dataStart, dataEnd - dataStart))
+			offset = dataEnd
+
+	except OSError, e:
+		if e.errno != errno.EINVAL:
+			raise
+		segments = [(0, size)]
+
+	return segments
+
+# -----------------------------------------------------
+# _copySegment
+# -----------------------------------------------------
+def _copySegment(sourceFd, destFd, offset, length, useCopyRange):
+	"""
+	Copy one segment of a file to the same offset in the destination
+
+	RETURNS:
+		(useCopyRange, copiedEnd). useCopyRange is False if copy_file_range
+		stopped working and should not be used again. copiedEnd is the offset
+		copied up to, less than the segment end if the source ended early
+	"""
+
+	end = offset + length
+
+	while offset < end:
+		chunk = min(COPY_CHUNK_SIZE, end - offset)
+
+		if useCopyRange:
+			try:
+				copied = _copyFileRange(sourceFd, destFd, offset, chunk)
+			except OSError, e:
+				if e.errno not in COPY_RANGE_UNSUPPORTED_ERRORS:
+					raise
+				# fall back to read and write for the rest of the file
+				useCopyRange = False
+				continue
+
+			if not copied:
+				# some filesystems return 0 before the end of the file. Retry with
+				# read and write, which tells a real end of file apart
+				useCopyRange = False
+				continue
+
+		else:
+			os.lseek(sourceFd, offset, os.SEEK_SET)
+			data = os.read(sourceFd, chunk)
+			os.lseek(destFd, offset, os.SEEK_SET)
+
+			copied = 0
+			while copied < len(data):
+				copied += os.write(destFd, data[copied:])
+
+		if not copied:
+			# the source file was truncated while copying
+			break
+
+		offset += copied
+
+	return useCopyRange, offset
+
+# -----------------------------------------------------
+# copyFile
+# -----------------------------------------------------
+def copyFile(source, dest):
+	"""
+	Copy the contents of source to dest, preserving holes in sparse files.
+	Like shutil.copyfile, dest is a file name and is overwritten
+
+	ARGS:
+		source: file to copy
+		dest: destination file name
+	"""
+
+	sourceStat = os.stat(source)
+	size = sourceStat.st_size
+
+	if size < LARGE_FILE_THRESHOLD:
+		shutil.copyfile(source, dest)
+		return
+
+	if os.path.exists(dest) and os.path.samefile(source, dest):
+		raise shutil.Error("%s and %s are the same file" % (source, dest))
+
+	sourceFd = os.open(source, os.O_RDONLY)
+	try:
+		destFd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+		try:
+			# a file with fewer allocated blocks than its size has holes
+			if sourceStat.st_blocks * 512 < size:
+				segments = _getDataSegments(sourceFd, size)
+
+				# setting the size first leaves holes wherever no data is written
+				os.ftruncate(destFd, size)
+			else:
+				segments = [(0, size)]
+				_fallocate(destFd, size)
+
+			useCopyRange = True
+			for offset, length in segments:
+				useCopyRange, copiedEnd = _copySegment(sourceFd, destFd, offset, length, useCopyRange)
+
+				if copiedEnd < offset + length:
+					# the source is shorter than when the copy started. Don't leave
+					# zero padding from the preset size
+					os.ftruncate(destFd, copiedEnd)
+					break
+
+		finally:
+			os.close(destFd)
+	finally:
+		os.close(sourceFd)
@@ -5,11 +5,58 @@
 import sys
 import os
 import argparse
-import time
-import shutil
 import datetime
-import pdb
 import hashlib
+import filecmp
+
+import fast_copy
+import timestamp_dir
+from copy_scheduler import CopyScheduler, DEFAULT_DEVICE_JOBS, DEFAULT_DEST_JOBS
+from external_sort import externalSort
+
+# optional faster hash implementations
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# size of the blocks read from a file while hashing it
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# number of copies queued before they are run, so memory stays bounded for huge plans
+COPY_BATCH_SIZE = 10000
+
+# digest size in bytes used for blake2b. The checksum is only a dedup key, so a short digest is enough
+BLAKE2B_DIGEST_SIZE = 16
+
+def getHashAlgorithms():
+    """ Return a dictionary of the available hash algorithm names and their hasher constructors """
+
+    algorithms = {"md5" : hashlib.md5, "sha1" : hashlib.sha1}
+
+    if blake2b:
+        algorithms["blake2b"] = lambda: blake2b(digest_size=BLAKE2B_DIGEST_SIZE)
+
+    if xxhash:
+        algorithms["xxhash"] = xxhash.xxh64
+
+    return algorithms
+
+def getDefaultHashAlgorithm():
+    """ Return the fastest hash algorithm that does not require an optional module """
+
+    if blake2b:
+        return "blake2b"
+
+    return "md5"
 
 ######################################
 class FileSorter:
@@ -17,13 +64,28 @@ class FileSorter:
     
     DUPLICATE_PATH = "duplicates"
 
-    def __init__(self):
+    def __init__(self, hash_algo=None, device_jobs=DEFAULT_DEVICE_JOBS, dest_jobs=DEFAULT_DEST_JOBS):
         """ initialize the destination directory """
+
+        if not hash_algo:
+            hash_algo = getDefaultHashAlgorithm()
+
+        algorithms = getHashAlgorithms()
+        if hash_algo not in algorithms:
+            raise Exception("Hash algorithm %s is not available. Choose from: %s" % (hash_algo, ", ".join(sorted(algorithms))))
+
+        self.hash_algo = hash_algo
+        self.hasher_factory = algorithms[hash_algo]
+
+        # maximum number of concurrent copies reading from, and writing to, each device
+        self.device_jobs = device_jobs
+        self.dest_jobs = dest_jobs
         
         self.total_file_count = 0
         self.duplicates_count = 0
         self.yearCount = {}
         self.duplicateYearCount = {}
+        self.parsed_file_count = 0
 
     def sortFiles(self, source_dirs, dest_dir, tag, by_month, test_only):
         """ Initialize the sorting of files by year """
@@ -31,32 +93,44 @@ class FileSorter:
         if test_only:
             print "Test only mode"
         
-        file_metadata_dict = self._parseFiles(source_dirs)
+        file_count, file_plan = self._parseFiles(source_dirs)
         
-        # create destination directories
-        st = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-        dest_dir = os.path.join(os.path.dirname(dest_dir), st + "_" + os.path.basename(dest_dir))
+        # create destination directories. The timestamped name is unique even if another sort starts at the same time
+        dest_dir = timestamp_dir.createTSDir(os.path.dirname(dest_dir), os.path.basename(dest_dir))
         
         # create duplicate path directory
         duplicate_dir = os.path.join(dest_dir, self.DUPLICATE_PATH)
 
         # we've finished reading every file. Now copy and re-name them
-        self._transferFiles(file_metadata_dict, dest_dir, duplicate_dir, tag, test_only)
+        self._transferFiles(file_plan, file_count, dest_dir, duplicate_dir, tag, test_only)
 
         # print statistics when we're done
         self._printStatistic()
 
     def _parseFiles(self, source_dirs):
-        """ Parse each file in the list of source directories for meta data """
-        
-        file_list = []
-        file_metadata_dict = {}
-        files_dict = {}
+        """ Parse each file in the list of source directories for meta data. Returns the number of files
+            and the transfer plan, sorted by checksum so duplicates are adjacent """
         
         # validate every source directory
         for source in source_dirs:
             if not os.path.exists(source):
                 raise Exception("Source directory %s does not exist!" % source)
+
+        # sort the metadata on disk, so the plan does not need to fit in memory
+        file_plan = externalSort(self._iterFileMetaData(source_dirs))
+
+        file_count = self.parsed_file_count
+
+        print "\nDiscovered %d files" % file_count
+
+        return file_count, file_plan
+
+    def _iterFileMetaData(self, source_dirs):
+        """ Yield a (checksum algorithm, checksum, file path, modified time) record for each file in the source directories """
+
+        self.parsed_file_count = 0
+
+        for source in source_dirs:
         
             # read all files in the nested directory structure
             for root, dirs, files in os.walk(source):
@@ -64,29 +138,15 @@ class FileSorter:
                 # save metadata for each file in the discovered in the file path
                 for name in files:
                     full_file_path = os.path.join(source, root, name)
-                    
-                    file_list.append(full_file_path)
-                    
-                    
-        file_count = len(file_list)
-                    
-        print "Discovered %d files" % file_count
-        
-        count = 0
-                    
-        for full_file_path in file_list:
-        
-            count += 1
-            sys.stdout.write("Parsing file %d of %d \r" % (count, file_count))
-            sys.stdout.flush()
 
-            # extract the file's meta data
-            year, create_datetime, file_checksum = self._extractFileMetaData(full_file_path)
-                    
-            # save metadata for the file
-            file_metadata_dict[full_file_path] = {"year" : year, "create_dt" : create_datetime, "chksum" : file_checksum}
-                    
-        return file_metadata_dict
+                    self.parsed_file_count += 1
+                    sys.stdout.write("Parsing file %d \r" % self.parsed_file_count)
+                    sys.stdout.flush()
+
+                    # extract the file's meta data
+                    create_time, file_checksum = self._extractFileMetaData(full_file_path)
+
+                    yield (self.hash_algo, file_checksum, full_file_path, create_time)
 
     def _extractFileMetaData(self, file_name):
         """ For each file path, internally catalog the file by getting its timestamp and checksum """
@@ -99,40 +159,54 @@ class FileSorter:
 
         # get the file creation time stamp
         create_time = os.path.getmtime(file_name)
-        create_datetime = datetime.datetime.fromtimestamp(create_time)
-
-        # get the create year
-        create_year = str(create_datetime.year)
 
-        return create_year, create_datetime, file_checksum
+        return create_time, file_checksum
         
     def _getFileChecksum(self, file_name_and_path):
         """ Generate the checksum of a file """
 
         # algorithm from http://pythoncentral.io/hashing-files-with-python/
-        hasher = hashlib.md5()
+        # read the file in blocks so large files are not loaded into memory at once
+        hasher = self.hasher_factory()
         with open(file_name_and_path, 'rb') as afile:
-            buf = afile.read()
-            hasher.update(buf)
+            buf = afile.read(HASH_BLOCK_SIZE)
+            while buf:
+                hasher.update(buf)
+                buf = afile.read(HASH_BLOCK_SIZE)
             return hasher.hexdigest()
 
-    def _transferFiles(self, file_metadata_dict, dest_dir, duplicate_dir, tag, test_only):
+    def _isDuplicate(self, file_path, candidate_paths):
+        """ Compare a file byte for byte against files with the same checksum. Guards against hash collisions """
+
+        for candidate_path in candidate_paths:
+            if filecmp.cmp(file_path, candidate_path, shallow=False):
+                return True
+
+        return False
+
+    def _transferFiles(self, file_plan, file_count, dest_dir, duplicate_dir, tag, test_only):
         """ copy files from a source location to the destiation location.  Copy duplicates
-            to a duplicate directory """
+            to a duplicate directory. file_plan must be sorted by checksum """
 
-        # look for duplicates
-        checksum_list = []
+        # look for duplicates. The plan is sorted, so only the files copied for the current
+        # (algorithm, checksum) need to be remembered
+        current_checksum = None
+        checksum_files = []
         count = 0
-        file_count = len(file_metadata_dict.keys())
-        
-        pdb.set_trace()
+
+        # copies between separate devices run in parallel. Sparse files keep their holes
+        scheduler = CopyScheduler(fast_copy.copyFile, self.device_jobs, self.dest_jobs)
                 
         # iterate through every file
-        for file_path, metadata in file_metadata_dict.iteritems():
+        for checksum_algo, file_checksum, file_path, create_time in file_plan:
         
-            create_ts = metadata.get("create_dt")
-            checksum = metadata.get("chksum")
-            year = metadata.get("year")
+            create_ts = datetime.datetime.fromtimestamp(create_time)
+            checksum = (checksum_algo, file_checksum)
+            year = str(create_ts.year)
+
+            if checksum != current_checksum:
+                current_checksum = checksum
+                checksum_files = []
         
             # create the new directory for the year
             year_dir_name = os.path.join(dest_dir, year, tag)
@@ -144,7 +218,7 @@ class FileSorter:
             dest_file_name = create_ts.strftime("%Y%m%d_%H%M%S") + "_" + os.path.basename(file_path)
 
             # check whether this file has been encountered before
-            if checksum in checksum_list:
+            if self._isDuplicate(file_path, checksum_files):
                 
                 ## This is a duplicate file. Move it to the duplicate directory ##
                 if not os.path.exists(duplicate_dir):
@@ -162,7 +236,7 @@ class FileSorter:
             else:
             
                 ## Copy the file
-                checksum_list.append(checksum)
+                checksum_files.append(file_path)
 
                 # file is not a duplicate, copy it
                 dest_file_name = os.path.join(year_dir_name, dest_file_name)
@@ -175,12 +249,24 @@ class FileSorter:
                 
             # print status
             count += 1
-            sys.stdout.write("Copying file %d of %d \r" % (count, file_count))
+            sys.stdout.write("Scheduling file %d of %d \r" % (count, file_count))
             sys.stdout.flush()
             
             if not test_only:
                 # Copy the file to the destination
-                shutil.copyfile(file_path, dest_file_name)
+                scheduler.addCopy(file_path, dest_file_name)
+
+                if scheduler.queuedCount >= COPY_BATCH_SIZE:
+                    self._runCopies(scheduler)
+
+        # perform the scheduled copies
+        self._runCopies(scheduler)
+
+    def _runCopies(self, scheduler):
+        """ perform the copies queued on the scheduler and report failures """
+
+        for source, dest, error in scheduler.run():
+            print "Unable to copy %s to %s: %s" % (source, dest, error)
 
     def _recordDuplicate(self, year):
         """ Record statistics about duplicate files """
@@ -238,6 +324,9 @@ def defineArgs(parser):
         parser.add_argument('-l', '--label', required=False, default="mobile", help='the label to apply to result directories')
         parser.add_argument('source_dirs', nargs='+', help='the source directories')
         parser.add_argument('-t', '--test', required=False, action='store_true', help='test only')
+        parser.add_argument('-j', '--device-jobs', required=False, type=int, default=DEFAULT_DEVICE_JOBS, help='maximum number of concurrent copies reading from each device')
+        parser.add_argument('--dest-jobs', required=False, type=int, default=DEFAULT_DEST_JOBS, help='maximum number of concurrent copies writing to each device')
+        parser.add_argument('--hash', required=False, default=getDefaultHashAlgorithm(), choices=sorted(getHashAlgorithms()), help='the hash algorithm used to detect duplicates')
         
 def main(): 
     print "Sorting files"
@@ -248,7 +337,10 @@ def main():
     # parse the arguments
     args = parser.parse_args()
 
-    sorter = FileSorter()
+    if args.device_jobs < 1 or args.dest_jobs < 1:
+        parser.error("--device-jobs and --dest-jobs must be at least 1")
+
+    sorter = FileSorter(args.hash, args.device_jobs, args.dest_jobs)
     sorter.sortFiles(args.source_dirs, args.dest, args.label, args.month, args.test)
        
 if __name__ == "__main__":
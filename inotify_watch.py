@@ -0,0 +1,271 @@
+#!/usr/bin/python
+#
+###############################################################################################################
+# Minimal inotify wrapper reporting files that were written, created or moved in watched paths
+#
+# Directories are watched recursively. New directories are watched as they appear and the files already
+# in them are reported, so nothing created before the watch was added is missed. Single files are watched
+# through their parent directory, so they are still seen after being replaced by a rename.
+###############################################################################################################
+
+import os
+import errno
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 02000000
+
+# events that mean a file has new contents
+FILE_CHANGED_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+
+# IN_CREATE is needed to find new directories
+WATCH_MASK = FILE_CHANGED_MASK | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event header: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct("iIII")
+
+# enough for a large number of events per read
+READ_SIZE = 64 * 1024
+
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+	_libc = None
+
+if _libc and hasattr(_libc, "inotify_init1"):
+	_libc.inotify_init1.argtypes = [ctypes.c_int]
+	_libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+# -----------------------------------------------------
+# _checkCall
+# -----------------------------------------------------
+def _checkCall(result):
+	""" raise an OSError if a libc call failed """
+
+	if result < 0:
+		error = ctypes.get_errno()
+		raise OSError(error, os.strerror(error))
+
+	return result
+
+# -----------------------------------------------------
+# Class InotifyWatch
+# -----------------------------------------------------
+class InotifyWatch(object):
+	"""
+	Watch files and directory trees for changed files
+	"""
+
+	# -----------------------------------------------------
+	# __init__
+	# -----------------------------------------------------
+	def __init__(self, excludePaths=[], ignoreNames=[]):
+		"""
+		constructor
+
+		ARGS:
+			excludePaths: directories that are never watched or reported
+			ignoreNames: file and directory names that are never watched or reported
+		"""
+
+		if not _libc or not hasattr(_libc, "inotify_init1"):
+			raise OSError(errno.ENOSYS, "inotify is not available on this system")
+
+		self.fd = _checkCall(_libc.inotify_init1(IN_CLOEXEC))
+
+		self.excludePaths = [os.path.realpath(path) for path in excludePaths]
+		self.ignoreNames = ignoreNames
+
+		# maps watch descriptors to the watched path
+		self.watches = {}
+
+		# maps watch descriptors to the names reported from that directory. None reports every name
+		self.nameFilters = {}
+
+		# time the last batch of events was read, whether or not it changed any files
+		self.lastEventTime = None
+
+		# set when the kernel event queue overflowed and events were lost
+		self.overflowed = False
+
+	# -----------------------------------------------------
+	# close
+	# -----------------------------------------------------
+	def close(self):
+		""" stop watching all paths """
+
+		os.close(self.fd)
+		self.watches = {}
+		self.nameFilters = {}
+
+	# -----------------------------------------------------
+	# isIgnored
+	# -----------------------------------------------------
+	def isIgnored(self, path):
+		""" Return True if path is excluded from watching """
+
+		if os.path.basename(path) in self.ignoreNames:
+			return True
+
+		realPath = os.path.realpath(path)
+		for excludePath in self.excludePaths:
+			if realPath == excludePath or realPath.startswith(excludePath + os.sep):
+				return True
+
+		return False
+
+	# -----------------------------------------------------
+	# addWatch
+	# -----------------------------------------------------
+	def addWatch(self, path):
+		"""
+		Watch a file, or a directory and all its sub directories
+
+		ARGS:
+			path: file or directory to watch
+
+		RETURNS:
+			A list of files found in newly watched directories
+		"""
+
+		foundFiles = []
+
+		if self.isIgnored(path):
+			return foundFiles
+
+		if not os.path.isdir(path):
+			# watch the parent directory, a file replaced by a rename gets a new inode
+			path = os.path.abspath(path)
+			self._addWatch(os.path.dirname(path), os.path.basename(path))
+			return foundFiles
+
+		for root, dirs, files in os.walk(path):
+
+			# don't descend into ignored directories
+			dirs[:] = [name for name in dirs if not self.isIgnored(os.path.join(root, name))]
+
+			self._addWatch(root)
+
+			for name in files:
+				fullName = os.path.join(root, name)
+				if not self.isIgnored(fullName):
+					foundFiles.append(fullName)
+
+		return foundFiles
+
+	# -----------------------------------------------------
+	# _addWatch
+	# -----------------------------------------------------
+	def _addWatch(self, path, name=None):
+		"""
+		add a single inotify watch on a directory. Paths removed before the
+		watch is added are skipped
+
+		ARGS:
+			path: directory to watch
+			name: if set, only report this name from the directory. Other names
+				can be added by further calls
+		"""
+
+		try:
+			wd = _checkCall(_libc.inotify_add_watch(self.fd, path, WATCH_MASK))
+		except OSError, e:
+			if e.errno in [errno.ENOENT, errno.ENOTDIR]:
+				return
+			raise
+
+		self.watches[wd] = os.path.abspath(path)
+
+		# adding a watch for the same directory again returns the same descriptor
+		if name is None:
+			self.nameFilters[wd] = None
+		elif wd not in self.nameFilters:
+			self.nameFilters[wd] = set([name])
+		elif self.nameFilters[wd] is not None:
+			self.nameFilters[wd].add(name)
+
+	# -----------------------------------------------------
+	# readChanges
+	# -----------------------------------------------------
+	def readChanges(self, timeout=None):
+		"""
+		Wait for events and return the files they refer to
+
+		ARGS:
+			timeout: seconds to wait for events. Wait forever if None
+
+		RETURNS:
+			A set of absolute paths of changed files. Empty if the timeout expired
+		"""
+
+		changedFiles = set()
+
+		readable, writable, errors = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return changedFiles
+
+		data = os.read(self.fd, READ_SIZE)
+		offset = 0
+
+		self.lastEventTime = time.time()
+
+		while offset < len(data):
+			wd, mask, cookie, nameLength = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+
+			name = data[offset:offset + nameLength].rstrip("\0")
+			offset += nameLength
+
+			if mask & IN_Q_OVERFLOW:
+				self.overflowed = True
+				continue
+
+			watchPath = self.watches.get(wd)
+			if watchPath is None:
+				continue
+
+			if mask & IN_IGNORED:
+				# the watched path was removed
+				del self.watches[wd]
+				self.nameFilters.pop(wd, None)
+				continue
+
+			if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+				continue
+
+			# directories watched for single files only report those files
+			nameFilter = self.nameFilters.get(wd)
+			if nameFilter is not None and name not in nameFilter:
+				continue
+
+			path = os.path.join(watchPath, name) if name else watchPath
+
+			if self.isIgnored(path):
+				continue
+
+			if mask & IN_ISDIR:
+				if nameFilter is not None:
+					# a directory replaced a watched file, there is nothing to archive
+					continue
+
+				# watch new directories, and report files created before the watch existed
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					changedFiles.update(self.addWatch(path))
+
+			elif mask & FILE_CHANGED_MASK and os.path.isfile(path):
+				changedFiles.add(path)
+
+		return changedFiles
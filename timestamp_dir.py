@@ -0,0 +1,143 @@
+#!/usr/bin/python
+#
+###############################################################################################################
+# Create timestamped directories, shared by archive.py, file_sorter.py and unix/mktsdir.sh
+#
+# Directory names have the format YYYY-MM-DD_HH-MM-SS.ffffff-SEQ[_NAME], with a fixed width sequence
+# number so names sort by time. Directories are created with a single mkdir, and the sequence number is
+# increased if the name is already taken, so jobs starting at the same moment never share a directory.
+###############################################################################################################
+
+import os
+import errno
+import argparse
+import datetime
+
+# timestamp format of directory names, followed by microseconds
+TIMESTAMP_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+# width of the sequence number, and the number of directories possible with the same timestamp
+SEQUENCE_DIGITS = 3
+MAX_SEQUENCE = 10 ** SEQUENCE_DIGITS
+
+# -----------------------------------------------------
+# formatTimestamp
+# -----------------------------------------------------
+def formatTimestamp(timestamp=None):
+	"""
+	Format a timestamp for a directory name
+
+	ARGS:
+		timestamp: datetime to format. Defaults to now
+
+	RETURNS:
+		The timestamp in the format YYYY-MM-DD_HH-MM-SS.ffffff
+	"""
+
+	if timestamp is None:
+		timestamp = datetime.datetime.now()
+
+	return "%s.%06d" % (timestamp.strftime(TIMESTAMP_FORMAT), timestamp.microsecond)
+
+# -----------------------------------------------------
+# _createUniqueDir
+# -----------------------------------------------------
+def _createUniqueDir(parentDir, timestampString, name, sequence):
+	"""
+	Create the first free directory for timestampString, starting at sequence
+
+	RETURNS:
+		(path of the created directory, sequence used)
+	"""
+
+	while sequence < MAX_SEQUENCE:
+		dirName = "%s-%0*d" % (timestampString, SEQUENCE_DIGITS, sequence)
+		if name:
+			dirName = "%s_%s" % (dirName, name)
+
+		path = os.path.join(parentDir, dirName)
+
+		try:
+			# mkdir fails if the directory exists, so only one caller can get each name
+			os.mkdir(path)
+			return path, sequence
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+
+		sequence += 1
+
+	raise OSError(errno.EEXIST, "Unable to find a free directory name for %s in %s" % (timestampString, parentDir))
+
+# -----------------------------------------------------
+# reserveTSDirs
+# -----------------------------------------------------
+def reserveTSDirs(parentDir, count, name=None, timestamp=None):
+	"""
+	Create a batch of timestamped directories sharing one timestamp,
+	for example one per parallel archive job
+
+	ARGS:
+		parentDir: directory to create the timestamped directories in. Created if missing
+		count: number of directories to create
+		name: optional name appended to each directory name
+		timestamp: datetime used for the names. Defaults to now
+
+	RETURNS:
+		A list of the created directory paths, in sequence order
+	"""
+
+	parentDir = parentDir or os.curdir
+
+	try:
+		os.makedirs(parentDir)
+	except OSError, e:
+		if e.errno != errno.EEXIST:
+			raise
+
+	timestampString = formatTimestamp(timestamp)
+
+	paths = []
+	sequence = 0
+
+	for index in range(count):
+		path, sequence = _createUniqueDir(parentDir, timestampString, name, sequence)
+		paths.append(path)
+		sequence += 1
+
+	return paths
+
+# -----------------------------------------------------
+# createTSDir
+# -----------------------------------------------------
+def createTSDir(parentDir, name=None, timestamp=None):
+	"""
+	Create a single timestamped directory
+
+	ARGS:
+		parentDir: directory to create the timestamped directory in. Created if missing
+		name: optional name appended to the directory name
+		timestamp: datetime used for the name. Defaults to now
+
+	RETURNS:
+		The path of the created directory
+	"""
+
+	return reserveTSDirs(parentDir, 1, name, timestamp)[0]
+
+# -----------------------------------------------------
+# main
+# -----------------------------------------------------
+def main():
+	""" create timestamped directories in the current directory """
+
+	parser = argparse.ArgumentParser(description="Create a directory named with the current timestamp")
+	parser.add_argument('name', nargs='?', help='optional name appended to the timestamp')
+	parser.add_argument('-n', '--count', type=int, default=1, help='number of directories to create')
+	args = parser.parse_args()
+
+	for path in reserveTSDirs(os.curdir, args.count, args.name):
+		print "create dir %s" % os.path.basename(path)
+
+if __name__ == "__main__":
+	main()
@@ -1,17 +1,8 @@
 #!/bin/bash
 # create a directory with a timestamp.  Optionally provide the directory name
-# example directory name [TIMESTAMP]-[DIRECTORY NAME]
+# example directory name [TIMESTAMP]_[DIRECTORY NAME]
+# the name is generated by timestamp_dir.py, shared with the python tools
 
-datestring=`date +"%y-%m-%d_%H-%M-%S"`
+declare -r TOOL_DIR=$(dirname "$(readlink -f "$0")")/..
 
-if [ $# -eq 1 ] 
-then
-	# input directory provided
-	dir_name=$datestring"_"$1
-	echo "create dir $dir_name"
-	mkdir $dir_name
-else
-	# no directory name provided. Just make timestamp dir
-	echo "create dir $datestring"
-	mkdir $datestring
-fi
+python "${TOOL_DIR}/timestamp_dir.py" "$@"